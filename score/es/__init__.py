@@ -24,7 +24,9 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
-from ._init import init, ConfiguredEsModule
+from ._init import init, ConfiguredEsModule, SearchResult
+from ._breaker import CircuitBreaker, CircuitOpenError
 
 
-__all__ = ('init', 'ConfiguredEsModule')
+__all__ = ('init', 'ConfiguredEsModule', 'SearchResult', 'CircuitBreaker',
+           'CircuitOpenError')
@@ -0,0 +1,108 @@
+# Copyright © 2015 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from threading import Lock
+from time import time
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of contacting elasticsearch while the
+    :class:`.CircuitBreaker` is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Keeps track of failing (or slow) elasticsearch requests and decides whether
+    further requests should be attempted at all.
+
+    The breaker *opens* after *failures* consecutive failed requests. A request
+    is considered failed if it raised an exception, or if it took longer than
+    *latency* seconds (if *latency* is not `None`). While the breaker is open,
+    :meth:`.allow` will return `False` until *cooldown* seconds have passed.
+
+    After the cool-down period, the breaker is *half-open*: :meth:`.allow`
+    lets exactly one request pass as a probe and keeps returning `False` for
+    all others. If the probe succeeds, the breaker closes again, otherwise it
+    stays open for another *cooldown* seconds. Every call to :meth:`.allow`
+    returning `True` must thus be followed by a call to either
+    :meth:`.success` or :meth:`.failure`.
+    """
+
+    def __init__(self, failures, latency=None, cooldown=30):
+        self.failures = failures
+        self.latency = latency
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def open(self):
+        """
+        Whether the breaker is currently open or half-open, i.e. whether
+        requests are currently being short-circuited.
+        """
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """
+        Returns whether a request may be sent to elasticsearch right now.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def success(self, duration):
+        """
+        Must be called after a request finished without an error. The
+        *duration* of the request in seconds is compared against the configured
+        *latency* threshold.
+        """
+        if self.latency is not None and duration > self.latency:
+            self.failure()
+            return
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self):
+        """
+        Must be called after a request failed.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failures:
+                self._opened_at = time()
+                self._probing = False
@@ -24,20 +24,38 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from elasticsearch import Elasticsearch, helpers
-from elasticsearch.exceptions import NotFoundError
-from score.init import ConfiguredModule, parse_list, parse_bool, extract_conf
+from elasticsearch.exceptions import (
+    NotFoundError, TransportError, ConnectionError)
+from elasticsearch.serializer import JSONSerializer
+from score.init import (
+    ConfiguredModule, parse_list, parse_bool, extract_conf,
+    parse_time_interval, parse_dotted_path)
 from sqlalchemy import event
 from time import time
+import gzip
 import inspect
 import logging
 from functools import partial
+from threading import Lock
+from ._breaker import CircuitBreaker, CircuitOpenError
 
 
 log = logging.getLogger(__name__)
 
+serializer = JSONSerializer()
+
 defaults = {
     'ctx.member': 'es',
+    'timeout': None,
+    'breaker.failures': 0,
+    'breaker.latency': None,
+    'breaker.cooldown': '30s',
+    'breaker.buffer': 10000,
+    'fallback': None,
+    'bulk_events': False,
 }
 
 
@@ -50,9 +68,23 @@ def init(confdict, db, ctx=None):
         A list of hosts (as read by :func:`score.init.parse_list`) to pass to
         the :class:`Elasticsearch <elasticsearch.Elasticsearch>` constructor.
 
+    :confkey:`args.maxsize`
+        The maximum number of connections to keep open to each host. This is
+        also the maximum number of concurrent requests per host.
+
+    :confkey:`args.sniff_on_start`, :confkey:`args.sniff_on_connection_fail`
+        Boolean values (as read by :func:`score.init.parse_bool`) enabling the
+        discovery of further cluster nodes.
+
+    :confkey:`args.*timeout`
+        The values of ``args.timeout``, ``args.sniffer_timeout`` and
+        ``args.sniff_timeout`` are passed to the client as floats (in seconds).
+
     :confkey:`args.*`
         Any other arguments to be passed to the :class:`Elasticsearch
-        <elasticsearch.Elasticsearch>` constructor.
+        <elasticsearch.Elasticsearch>` constructor. The client itself is
+        constructed on first access to :attr:`ConfiguredEsModule.es`, i.e.
+        after forking worker processes.
 
     :confkey:`index` :confdefault:`score`
         The index to use in all operations.
@@ -64,20 +96,87 @@ def init(confdict, db, ctx=None):
 
         >>> for knight in ctx.es.query(User, 'name:sir*')
         ...     print(knight.name)
+
+    :confkey:`timeout` :confdefault:`None`
+        Default timeout for all requests issued by :meth:`.query
+        <ConfiguredEsModule.query>`, :meth:`.insert
+        <ConfiguredEsModule.insert>`, :meth:`.delete
+        <ConfiguredEsModule.delete>` and :meth:`.refresh
+        <ConfiguredEsModule.refresh>`, as interpreted by
+        :func:`score.init.parse_time_interval`. The default leaves the timeout
+        of the :class:`Elasticsearch <elasticsearch.Elasticsearch>` client
+        untouched.
+
+    :confkey:`breaker.failures` :confdefault:`0`
+        The number of consecutive failed requests, after which the
+        :ref:`circuit breaker <es_circuit_breaker>` opens. The default value
+        disables the circuit breaker.
+
+    :confkey:`breaker.latency` :confdefault:`None`
+        A time interval: requests taking longer than this are counted as
+        failures by the circuit breaker.
+
+    :confkey:`breaker.cooldown` :confdefault:`30s`
+        The time interval the circuit breaker remains open before another
+        request is attempted.
+
+    :confkey:`breaker.buffer` :confdefault:`10000`
+        Maximum number of index operations to keep in the retry buffer while
+        the circuit breaker is open. The oldest operations are discarded once
+        this limit is reached.
+
+    :confkey:`fallback` :confdefault:`None`
+        Dotted path to a callable to invoke instead of :meth:`.query
+        <ConfiguredEsModule.query>` while the circuit breaker is open. It
+        receives the same arguments as :meth:`.query
+        <ConfiguredEsModule.query>` (excluding *timeout*) and must return an
+        iterable of objects. Queries will raise a :class:`.CircuitOpenError`
+        if this value is omitted.
+
+    :confkey:`bulk_events` :confdefault:`False`
+        Whether bulk operations performed with
+        :meth:`sqlalchemy.orm.Query.update` and
+        :meth:`sqlalchemy.orm.Query.delete` should be reflected in the index.
+        See :ref:`es_bulk_operations` for details.
     """
     conf = defaults.copy()
     conf.update(confdict)
     kwargs = extract_conf(confdict, 'args.')
     if 'hosts' in kwargs:
         kwargs['hosts'] = parse_list(kwargs['hosts'])
-    if 'verify_certs' in kwargs:
-        kwargs['verify_certs'] = parse_bool(kwargs['verify_certs'])
-    if 'use_ssl' in kwargs:
-        kwargs['use_ssl'] = parse_bool(kwargs['use_ssl'])
-    es = Elasticsearch(**kwargs)
+    for key in ('verify_certs', 'use_ssl', 'sniff_on_start',
+                'sniff_on_connection_fail', 'retry_on_timeout'):
+        if key in kwargs:
+            kwargs[key] = parse_bool(kwargs[key])
+    for key in ('maxsize', 'max_retries'):
+        if key in kwargs:
+            kwargs[key] = int(kwargs[key])
+    for key in ('timeout', 'sniffer_timeout', 'sniff_timeout'):
+        if key in kwargs:
+            kwargs[key] = float(kwargs[key])
     if 'index' not in confdict:
         confdict['index'] = 'score'
-    es_conf = ConfiguredEsModule(db, es, confdict['index'])
+    timeout = None
+    if conf['timeout'] not in (None, 'None'):
+        timeout = parse_time_interval(conf['timeout'])
+    breaker = None
+    if int(conf['breaker.failures']):
+        latency = None
+        if conf['breaker.latency'] not in (None, 'None'):
+            latency = parse_time_interval(conf['breaker.latency'])
+        breaker = CircuitBreaker(
+            int(conf['breaker.failures']),
+            latency=latency,
+            cooldown=parse_time_interval(conf['breaker.cooldown']))
+    fallback = None
+    if conf['fallback'] not in (None, 'None'):
+        fallback = parse_dotted_path(conf['fallback'])
+    es_conf = ConfiguredEsModule(
+        db, None, confdict['index'],
+        es_factory=partial(Elasticsearch, **kwargs),
+        timeout=timeout, breaker=breaker,
+        fallback=fallback, buffer_size=int(conf['breaker.buffer']))
+    es_conf._precompute()
     to_insert = []
     to_delete = []
 
@@ -117,36 +216,377 @@ def init(confdict, db, ctx=None):
             es_conf.insert(obj)
         for obj in to_delete:
             es_conf.delete(obj)
+
+    if parse_bool(conf['bulk_events']):
+
+        def affected_ids(context, operation):
+            """
+            Returns the ids of the rows affected by a bulk *operation*, or
+            `None` if they cannot be determined. The ids are only known, if the
+            operation was performed with ``synchronize_session='fetch'`` or
+            ``synchronize_session='evaluate'``. The latter only covers rows
+            that were loaded into the session, though.
+            """
+            cls = context.query.column_descriptions[0]['entity']
+            if getattr(context, 'matched_rows', None) is not None:
+                return [row[0] for row in context.matched_rows]
+            if getattr(context, 'matched_objects', None) is None:
+                log.warning(
+                    'cannot %s %s objects in the index after a bulk %s, '
+                    'use synchronize_session="fetch"' %
+                    ('remove' if operation == 'delete' else 'update',
+                     cls.__name__, operation))
+                return None
+            ids = [obj.id for obj in context.matched_objects]
+            if context.result.rowcount > len(ids):
+                log.warning(
+                    'only %d of %d %s objects affected by a bulk %s were '
+                    'loaded in the session and will be updated in the index, '
+                    'use synchronize_session="fetch"' %
+                    (len(ids), context.result.rowcount, cls.__name__,
+                     operation))
+            return ids
+
+        @event.listens_for(db.Session, 'after_bulk_update')
+        def after_bulk_update(update_context):
+            """
+            Re-inserts all rows affected by a :meth:`Query.update()
+            <sqlalchemy.orm.Query.update>`. See ``affected_ids``, above, for
+            the limitations.
+            """
+            cls = update_context.query.column_descriptions[0]['entity']
+            if es_conf.get_es_class(cls) is None:
+                return
+            ids = affected_ids(update_context, 'update')
+            if not ids:
+                return
+            session = update_context.session
+            for i in range(0, len(ids), 500):
+                es_conf.reindex(session.query(cls).
+                                filter(cls.id.in_(ids[i:i + 500])))
+
+        @event.listens_for(db.Session, 'after_bulk_delete')
+        def after_bulk_delete(delete_context):
+            """
+            Removes all rows deleted by a :meth:`Query.delete()
+            <sqlalchemy.orm.Query.delete>` from the index. See
+            ``affected_ids``, above, for the limitations.
+            """
+            cls = delete_context.query.column_descriptions[0]['entity']
+            if es_conf.get_es_class(cls) is None:
+                return
+            ids = affected_ids(delete_context, 'delete')
+            if ids:
+                es_conf.delete_ids(cls, ids)
+
     if ctx and conf['ctx.member'] not in (None, 'None'):
         ctx.register(conf['ctx.member'], lambda ctx: CtxProxy(es_conf, ctx))
     return es_conf
 
 
+SearchResult = namedtuple('SearchResult', ('hits', 'total', 'aggregations'))
+SearchResult.__doc__ = """
+The return value of :meth:`.ConfiguredEsModule.search`. The *hits* are the
+objects of the requested page, *total* is the number of matching documents and
+*aggregations* contains the aggregation results exactly as returned by
+elasticsearch.
+"""
+
+
 class ConfiguredEsModule(ConfiguredModule):
     """
     This module's :class:`configuration class
     <score.init.ConfiguredModule>`.
     """
 
-    def __init__(self, db, es, index):
+    def __init__(self, db, es, index, *, es_factory=None, timeout=None,
+                 breaker=None, fallback=None, buffer_size=10000):
+        if es is None and es_factory is None:
+            raise ValueError('Either an es client or an es_factory is required')
         self.db = db
-        self.es = es
+        self._es = es
+        self._es_factory = es_factory
+        self._es_lock = Lock()
         self.index = index
+        self.timeout = timeout
+        self.breaker = breaker
+        self.fallback = fallback
+        self.buffer = deque(maxlen=buffer_size)
+        self._buffer_lock = Lock()
+        self._flushing = False
         self._converters = {}
+        self._es_classes = {}
 
-    def insert(self, object_):
+    @property
+    def es(self):
         """
-        Inserts an *object_* into the index.
+        The :class:`elasticsearch.Elasticsearch` client. If the constructor
+        received an *es_factory* instead of a client, the factory is invoked
+        on first access, so each forked worker will open its own connections.
         """
-        body = self._object2json(object_)
-        doc_type = body['_type']
-        del body['_id']
-        del body['_type']
-        self.es.index(
-            index=self.index,
-            doc_type=doc_type,
+        if self._es is None:
+            with self._es_lock:
+                if self._es is None:
+                    self._es = self._es_factory()
+        return self._es
+
+    def _precompute(self):
+        """
+        Populates the :meth:`es class lookup <.get_es_class>` and the
+        converters for all database classes known at this point. Calling this
+        before forking allows all workers to share these structures. Classes
+        defined later are added to both on first use.
+        """
+        def recurse(cls):
+            for c in cls.__subclasses__():
+                if c not in self._converters and \
+                        self.get_es_class(c) is not None:
+                    self._converters[c] = self._mkconverter(c)
+                recurse(c)
+        recurse(self.db.Base)
+
+    def _call(self, func, *, timeout=None, **kwargs):
+        """
+        Invokes the elasticsearch API function *func* with given *kwargs*,
+        applying the configured timeout and keeping the :attr:`.breaker`
+        up to date. Raises :class:`.CircuitOpenError` without calling *func*
+        if the breaker is currently open.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            kwargs['request_timeout'] = timeout
+        if self.breaker is None:
+            return func(**kwargs)
+        if not self.breaker.allow():
+            raise CircuitOpenError()
+        start = time()
+        try:
+            result = func(**kwargs)
+        except BaseException as e:
+            # the breaker must be notified in any case, it might be waiting
+            # for the outcome of this probe request
+            if self._is_failure(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success(time() - start)
+            raise
+        self.breaker.success(time() - start)
+        return result
+
+    def _request_kwargs(self, timeout=None):
+        """
+        Returns the keyword arguments for applying given *timeout*, or the
+        configured default, to a request.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return {}
+        return {'request_timeout': timeout}
+
+    def _is_failure(self, exception):
+        """
+        Whether given *exception* indicates a problem with the cluster (as
+        opposed to a problem with the request itself, like a malformed query).
+        """
+        if isinstance(exception, ConnectionError):
+            return True
+        if isinstance(exception, TransportError):
+            status = exception.status_code
+            return not isinstance(status, int) or status >= 500
+        return False
+
+    def _write(self, action, timeout=None):
+        """
+        Sends a single bulk *action* to elasticsearch. The action is diverted
+        to the retry :attr:`.buffer` if the :attr:`.breaker` is open, or if the
+        request fails due to a cluster problem. If there are buffered actions,
+        or if the buffer is currently being flushed, the action is queued
+        behind them to preserve the order of operations.
+        """
+        if self.breaker is None:
+            self._send(action, timeout)
+            return
+        if self._enqueue_if_pending([action]):
+            self.flush_buffer(timeout)
+            return
+        try:
+            self._send(action, timeout)
+        except CircuitOpenError:
+            self._enqueue([action])
+        except Exception as e:
+            if not self._is_failure(e):
+                raise
+            log.warning('buffering %s operation: %s' % (action['_op_type'], e))
+            self._enqueue([action])
+
+    def _enqueue(self, actions, *, prepend=False):
+        """
+        Adds given *actions* to the retry :attr:`.buffer`. The actions are
+        placed in front of the buffered operations if *prepend* is `True`,
+        which is used for re-queueing actions that could not be sent. The
+        oldest operations are discarded (with a warning) if the buffer
+        overflows.
+        """
+        with self._buffer_lock:
+            self._enqueue_locked(actions, prepend)
+
+    def _enqueue_if_pending(self, actions):
+        """
+        Adds given *actions* to the retry :attr:`.buffer` if it is not empty,
+        or if it is currently being flushed. Returns whether the actions were
+        queued.
+        """
+        with self._buffer_lock:
+            if not self.buffer and not self._flushing:
+                return False
+            self._enqueue_locked(actions)
+            return True
+
+    def _enqueue_locked(self, actions, prepend=False):
+        """
+        Helper function for :meth:`._enqueue`, must be called while holding
+        the buffer lock.
+        """
+        overflow = len(self.buffer) + len(actions) - self.buffer.maxlen
+        if overflow > 0:
+            log.warning('retry buffer full, discarding %d operations' %
+                        overflow)
+        if not prepend:
+            # the deque discards the oldest entries on its own
+            self.buffer.extend(actions)
+            return
+        # the re-queued actions are the oldest ones, but extendleft() would
+        # discard entries at the other end
+        if overflow > 0:
+            actions = actions[overflow:]
+        self.buffer.extendleft(reversed(actions))
+
+    def _bulk(self, actions, timeout=None):
+        """
+        Sends given bulk *actions* to elasticsearch, keeping the
+        :attr:`.breaker` up to date. Errors of single actions are logged and
+        returned as a list, deletions of missing documents are not considered
+        errors.
+        """
+        success, errors = self._call(
+            partial(helpers.bulk, self.es, actions, raise_on_error=False),
+            timeout=timeout)
+        errors = [error for error in errors
+                  if error.get('delete', {}).get('status') != 404]
+        if errors:
+            log.warning('%d of %d bulk operations failed, first error: %s' %
+                        (len(errors), len(actions), errors[0]))
+        return errors
+
+    def _send(self, action, timeout=None):
+        """
+        Helper function for :meth:`._write`: performs a single bulk *action*
+        with the dedicated elasticsearch API function.
+        """
+        if action['_op_type'] == 'delete':
+            try:
+                self._call(
+                    self.es.delete,
+                    timeout=timeout,
+                    index=action['_index'],
+                    doc_type=action['_type'],
+                    id=action['_id'])
+            except NotFoundError:
+                pass
+            return
+        body = action.copy()
+        for key in ('_op_type', '_index', '_type', '_id'):
+            del body[key]
+        self._call(
+            self.es.index,
+            timeout=timeout,
+            index=action['_index'],
+            doc_type=action['_type'],
             body=body,
-            id=object_.id)
+            id=action['_id'])
+
+    def _write_bulk(self, actions, timeout=None):
+        """
+        Sends a list of bulk *actions* to elasticsearch and returns the errors
+        of single actions, as described in :meth:`._bulk`. The actions are
+        diverted to the retry :attr:`.buffer` under the same conditions as
+        described in :meth:`._write`, and queued behind buffered actions.
+        Errors of actions sent as part of a buffer flush are only logged.
+        """
+        if self.breaker is not None and self._enqueue_if_pending(actions):
+            self.flush_buffer(timeout)
+            return []
+        try:
+            return self._bulk(actions, timeout)
+        except CircuitOpenError:
+            pass
+        except Exception as e:
+            if self.breaker is None or not self._is_failure(e):
+                raise
+            log.warning('buffering %d operations: %s' % (len(actions), e))
+        self._enqueue(actions)
+        return []
+
+    def flush_buffer(self, timeout=None):
+        """
+        Sends all index operations, that were diverted to the retry
+        :attr:`.buffer` while the :attr:`.breaker` was open, to elasticsearch.
+        Operations are put back into the buffer if the flush fails due to a
+        problem with the cluster. Operations that cannot be sent for any other
+        reason, or that are rejected individually by elasticsearch, are logged
+        and dropped.
+        """
+        # operations queued while a flush is running are sent in another
+        # iteration by the same thread, keeping all operations in order
+        while True:
+            with self._buffer_lock:
+                if self._flushing or not self.buffer:
+                    return
+                self._flushing = True
+                actions = list(self.buffer)
+                self.buffer.clear()
+            try:
+                if not self._flush(actions, timeout):
+                    return
+            finally:
+                with self._buffer_lock:
+                    self._flushing = False
+
+    def _flush(self, actions, timeout=None):
+        """
+        Helper function for :meth:`.flush_buffer`: sends given buffered
+        *actions* and puts them back into the buffer if the cluster fails.
+        Returns whether the actions were sent.
+        """
+        try:
+            self._bulk(actions, timeout)
+        except CircuitOpenError:
+            self._enqueue(actions, prepend=True)
+            return False
+        except Exception as e:
+            if not self._is_failure(e):
+                # retrying would fail the same way and block all operations
+                # queued after these
+                log.exception('discarding %d buffered operations' %
+                              len(actions))
+                return True
+            log.warning('could not flush %d buffered operations: %s' %
+                        (len(actions), e))
+            self._enqueue(actions, prepend=True)
+            return False
+        return True
+
+    def insert(self, object_, *, timeout=None):
+        """
+        Inserts an *object_* into the index. The optional *timeout* overrides
+        the configured default.
+        """
+        action = self._object2json(object_)
+        action['_op_type'] = 'index'
+        action['_index'] = self.index
+        self._write(action, timeout)
 
     def _object2json(self, object_):
         """
@@ -207,21 +647,21 @@ class ConfiguredEsModule(ConfiguredModule):
                 return converter(getattr(object_, member))
         return getter
 
-    def delete(self, object_):
+    def delete(self, object_, *, timeout=None):
         """
-        Removes an *object_* from the index.
+        Removes an *object_* from the index. The optional *timeout* overrides
+        the configured default.
         """
         es_cls = self.get_es_class(object_)
-        try:
-            self.es.delete(
-                index=self.index,
-                doc_type=es_cls.__score_db__['type_name'],
-                id=object_.id)
-        except NotFoundError:
-            pass
+        self._write({
+            '_op_type': 'delete',
+            '_index': self.index,
+            '_type': es_cls.__score_db__['type_name'],
+            '_id': object_.id,
+        }, timeout)
 
     def query(self, ctx, class_, query, *,
-              analyze_wildcard=False, offset=0, limit=10):
+              analyze_wildcard=False, offset=0, limit=10, timeout=None):
         """
         Executes a lucene *query* on the index and yields a list of objects of
         given *class_*, retrieved from the database. It is also possible to
@@ -231,20 +671,95 @@ class ConfiguredEsModule(ConfiguredModule):
         The *query* can be provided as a string, or as a `query DSL`_. The
         parameter *analyze_wildcard* wildcard is passed to
         :meth:`elasticsearch.Elasticsearch.search`, whereas *offset* and *limit*
-        are mapped to *from_* and *size* respectively.
+        are mapped to *from_* and *size* respectively. The optional *timeout*
+        overrides the configured default.
+
+        If the :ref:`circuit breaker <es_circuit_breaker>` is open, the
+        configured :attr:`.fallback` will be invoked instead. A
+        :class:`.CircuitOpenError` is raised if there is no fallback.
 
         .. _query DSL: http://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl.html
         .. _multiple types at once: https://www.elastic.co/guide/en/elasticsearch/guide/master/multi-index-multi-type.html
         """
+        kwargs, doctype2class = self._search_kwargs(
+            class_, query, analyze_wildcard, offset, limit)
+        session = getattr(ctx, self.db.ctx_member)
+        try:
+            result = self._call(self.es.search, timeout=timeout, **kwargs)
+        except CircuitOpenError:
+            if self.fallback is None:
+                raise
+            yield from self.fallback(
+                ctx, class_, query, analyze_wildcard=analyze_wildcard,
+                offset=offset, limit=limit)
+            return
+        yield from self._hydrate(
+            session, doctype2class, result['hits']['hits'])
+
+    def search(self, ctx, class_, query, *, aggregations=None,
+               analyze_wildcard=False, offset=0, limit=10, timeout=None):
+        """
+        Same as :meth:`.query`, but returns a :class:`.SearchResult` containing
+        the hydrated objects of the requested page along with the results of
+        the given *aggregations*, all retrieved with a single request.
+
+        The *aggregations* must be a dict mapping names to `aggregation`_
+        definitions. If omitted, the result will contain the document counts
+        for each value of the :ref:`automatic fields <es_automatic_fields>`
+        ``class`` and ``concrete_class``:
+
+        >>> result = ctx.es.search(Text, 'title:parrot')
+        >>> for bucket in result.aggregations['concrete_class']['buckets']:
+        ...     print(bucket['key'], bucket['doc_count'])
+
+        If the :ref:`circuit breaker <es_circuit_breaker>` is open, the hits
+        will be retrieved from the configured :attr:`.fallback`, while the
+        *total* will be `None` and the *aggregations* empty.
+
+        .. _aggregation: https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations.html
+        """
+        if aggregations is None:
+            # terms aggregations return 10 buckets by default, make sure
+            # there is one for each class in the searched hierarchies
+            size = len(self._type_names(class_))
+            aggregations = {
+                'class': {'terms': {'field': 'class', 'size': size}},
+                'concrete_class': {
+                    'terms': {'field': 'concrete_class', 'size': size}},
+            }
+        kwargs, doctype2class = self._search_kwargs(
+            class_, query, analyze_wildcard, offset, limit)
+        kwargs.setdefault('body', {})['aggs'] = aggregations
+        session = getattr(ctx, self.db.ctx_member)
+        try:
+            result = self._call(self.es.search, timeout=timeout, **kwargs)
+        except CircuitOpenError:
+            if self.fallback is None:
+                raise
+            hits = list(self.fallback(
+                ctx, class_, query, analyze_wildcard=analyze_wildcard,
+                offset=offset, limit=limit))
+            return SearchResult(hits, None, {})
+        hits = list(self._hydrate(
+            session, doctype2class, result['hits']['hits']))
+        return SearchResult(
+            hits, result['hits']['total'], result.get('aggregations', {}))
+
+    def _search_kwargs(self, class_, query, analyze_wildcard, offset, limit):
+        """
+        Helper function for :meth:`.query` and :meth:`.search`: Returns the
+        keyword arguments for :meth:`elasticsearch.Elasticsearch.search` and a
+        dict mapping document types to the requested classes.
+        """
         if isinstance(class_, type):
             classes = [class_]
         else:
             classes = class_
         doctypes = []
         doctype2class = {}
-        for class_ in classes:
-            typename = self.get_es_class(class_).__score_db__['type_name']
-            doctype2class[typename] = class_
+        for cls in classes:
+            typename = self.get_es_class(cls).__score_db__['type_name']
+            doctype2class[typename] = cls
             doctypes.append(typename)
         kwargs = {
             'index': self.index,
@@ -258,19 +773,44 @@ class ConfiguredEsModule(ConfiguredModule):
             kwargs['q'] = query
         else:
             kwargs['body'] = {'query': query}
-        session = getattr(ctx, self.db.ctx_member)
-        result = self.es.search(**kwargs)
-        current_class = None
-        ids = []
-        for hit in result['hits']['hits']:
+        return kwargs, doctype2class
+
+    def _type_names(self, class_):
+        """
+        Returns the set of type names of all classes sharing the :term:`top-most
+        es class` with given *class_*, which may also be a list of classes.
+        """
+        if isinstance(class_, type):
+            class_ = [class_]
+        names = set()
+
+        def recurse(cls):
+            names.add(cls.__score_db__['type_name'])
+            for c in cls.__subclasses__():
+                recurse(c)
+        for cls in class_:
+            recurse(self.get_es_class(cls))
+        return names
+
+    def _hydrate(self, session, doctype2class, hits):
+        """
+        Retrieves the database objects for given search *hits* with a single
+        query per class and yields them in the order of the *hits*. Hits
+        without a corresponding database object are skipped.
+        """
+        ids = {}
+        for hit in hits:
             class_ = doctype2class[hit['_type']]
-            if class_ != current_class:
-                if current_class:
-                    yield from session.by_ids(current_class, ids)
-                current_class = class_
-                ids = []
-            ids.append(int(hit['_id']))
-        yield from session.by_ids(current_class, ids)
+            ids.setdefault(class_, []).append(int(hit['_id']))
+        objects = {}
+        for class_ in ids:
+            for object_ in session.by_ids(class_, ids[class_]):
+                if object_ is not None:
+                    objects[(class_, object_.id)] = object_
+        for hit in hits:
+            key = (doctype2class[hit['_type']], int(hit['_id']))
+            if key in objects:
+                yield objects[key]
 
     def get_es_class(self, object_):
         """
@@ -281,8 +821,6 @@ class ConfiguredEsModule(ConfiguredModule):
             cls = object_.__class__
         else:
             cls = object_
-        if not hasattr(self, '_es_classes'):
-            self._es_classes = {}
         if cls in self._es_classes:
             return self._es_classes[cls]
         initial_class = cls
@@ -296,28 +834,49 @@ class ConfiguredEsModule(ConfiguredModule):
         self._es_classes[initial_class] = result
         return result
 
+    def _require_es_class(self, class_):
+        """
+        Same as :meth:`.get_es_class`, but raises a :class:`ValueError` if
+        given *class_* is not stored in the index.
+        """
+        es_cls = self.get_es_class(class_)
+        if es_cls is None:
+            raise ValueError('%s is not stored in elasticsearch' %
+                             class_.__name__)
+        return es_cls
+
     def classes(self):
         """
         Provides a list of :term:`top-most classes <top-most es class>` with a
-        __score_es__ declaration.
+        __score_es__ declaration. The class hierarchy is inspected anew on each
+        call, so the list also contains classes defined after initialization.
         """
-        if hasattr(self, '_classes'):
-            return self._classes
-        self._classes = []
+        classes = []
 
         def recurse(cls):
             if hasattr(cls, '__score_es__'):
-                self._classes.append(cls)
+                classes.append(cls)
                 return
             for c in cls.__subclasses__():
                 recurse(c)
         recurse(self.db.Base)
-        return self._classes
+        return classes
 
-    def refresh(self, ctx):
+    def refresh(self, ctx, *, timeout=None, file=None):
         """
         Re-inserts every object into the lucene index. Note that this operation
-        might take a very long time, depending on the number of objects.
+        might take a very long time, depending on the number of objects. The
+        optional *timeout* applies to each bulk request and overrides the
+        configured default.
+
+        If a *file* is given, the documents are not sent to elasticsearch, but
+        written to a gzip-compressed file in the format expected by the `bulk
+        API`_ instead. The *file* may be a path or a file object opened in
+        binary mode. Such a file can later be passed to :meth:`.load`. No
+        requests are sent to elasticsearch in this case, so passing a
+        *timeout* as well raises a :class:`ValueError`.
+
+        .. _bulk API: https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
         """
         def generator():
             session = getattr(ctx, self.db.ctx_member)
@@ -325,11 +884,188 @@ class ConfiguredEsModule(ConfiguredModule):
                 start = time()
                 log.debug('indexing %s' % cls)
                 for obj in session.query(cls).yield_per(100):
-                    body = self._object2json(obj)
-                    body['_index'] = self.index
-                    yield body
+                    yield self._object2json(obj)
                 log.debug('indexed %s in %fs' % (cls, time() - start))
-        helpers.bulk(self.es, generator())
+        if file is not None:
+            if timeout is not None:
+                raise ValueError('Cannot apply a timeout when writing to a file')
+            self._dump(generator(), file)
+            return
+        helpers.bulk(self.es, generator(), index=self.index,
+                     **self._request_kwargs(timeout))
+
+    def _dump(self, documents, file):
+        """
+        Helper function for :meth:`.refresh`: Writes given *documents* to a
+        gzip-compressed bulk *file*. The action lines do not contain an
+        ``_index``, allowing :meth:`.load` to choose the target index.
+        """
+        if isinstance(file, str):
+            fileobj = gzip.open(file, 'wb')
+        else:
+            fileobj = gzip.GzipFile(fileobj=file, mode='wb')
+        with fileobj:
+            for body in documents:
+                action = {'index': {
+                    '_type': body.pop('_type'),
+                    '_id': body.pop('_id'),
+                }}
+                fileobj.write(serializer.dumps(action).encode('utf-8'))
+                fileobj.write(b'\n')
+                fileobj.write(serializer.dumps(body).encode('utf-8'))
+                fileobj.write(b'\n')
+
+    def load(self, file, *, thread_count=4, chunk_size=500, timeout=None):
+        """
+        Streams the contents of a bulk *file* created by :meth:`.refresh` into
+        the configured :attr:`.index` using *thread_count* parallel bulk
+        requests of *chunk_size* documents each. The *file* may be a path or a
+        file object opened in binary mode. The optional *timeout* applies to
+        each bulk request and overrides the configured default.
+
+        Returns the number of documents loaded. Raises a
+        :class:`elasticsearch.helpers.BulkIndexError` containing all rejected
+        documents, if there were any.
+
+        The file is processed as a stream, so problems with the file itself
+        are only detected when they are reached: if the file turns out to be
+        truncated, a :class:`ValueError` is raised *after* all preceding
+        documents were loaded, leaving the index partially filled.
+        """
+        if isinstance(file, str):
+            fileobj = gzip.open(file, 'rb')
+        else:
+            fileobj = gzip.GzipFile(fileobj=file, mode='rb')
+        kwargs = self._request_kwargs(timeout)
+        count = 0
+        errors = []
+
+        def chunks():
+            # lines are passed to elasticsearch verbatim
+            chunk = []
+            for number, line in enumerate(fileobj, 1):
+                chunk.append(line.decode('utf-8').rstrip('\n'))
+                if number % 2:
+                    continue
+                if len(chunk) >= 2 * chunk_size:
+                    yield chunk
+                    chunk = []
+            if len(chunk) % 2:
+                raise ValueError(
+                    'Truncated bulk file: missing document for the action in '
+                    'line %d' % number)
+            if chunk:
+                yield chunk
+
+        def send(chunk):
+            return self.es.bulk('\n'.join(chunk) + '\n', index=self.index,
+                                **kwargs)
+
+        def collect(futures):
+            nonlocal count
+            for future in futures:
+                for item in future.result()['items']:
+                    result = next(iter(item.values()))
+                    if 200 <= result.get('status', 500) < 300:
+                        count += 1
+                    else:
+                        errors.append(item)
+
+        # at most thread_count requests are pending at any time, so only
+        # those chunks are kept in memory
+        pending = set()
+        with fileobj, ThreadPoolExecutor(thread_count) as executor:
+            for chunk in chunks():
+                if len(pending) >= thread_count:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(send, chunk))
+            collect(wait(pending)[0])
+        if errors:
+            raise helpers.BulkIndexError(
+                '%d document(s) failed to index.' % len(errors), errors)
+        return count
+
+    def delete_by_query(self, class_, query=None, *, timeout=None):
+        """
+        Removes all documents of given *class_* matching given *query* from the
+        index with a single request. The *query* can be provided as a string
+        or as a query DSL, just like in :meth:`.query`. All documents of the
+        class will be removed if the *query* is omitted.
+
+        If *class_* is not a :term:`top-most es class`, only documents of this
+        class and its sub-classes are removed.
+
+        Unlike :meth:`.delete`, this operation cannot be buffered: it raises a
+        :class:`.CircuitOpenError` while the :attr:`.breaker` is open.
+        """
+        es_cls = self._require_es_class(class_)
+        if query is None:
+            query = {'match_all': {}}
+        elif isinstance(query, str):
+            query = {'query_string': {'query': query}}
+        if class_ is not es_cls:
+            query = {'bool': {'must': [
+                query,
+                {'term': {'class': class_.__score_db__['type_name']}},
+            ]}}
+        self._call(
+            self.es.delete_by_query,
+            timeout=timeout,
+            index=self.index,
+            doc_type=es_cls.__score_db__['type_name'],
+            body={'query': query})
+
+    def delete_ids(self, class_, ids, *, chunk_size=500, timeout=None):
+        """
+        Removes the documents of given *class_* with given *ids* from the index
+        using bulk requests of *chunk_size* documents each. This is far more
+        efficient than calling :meth:`.delete` for each object.
+
+        Just like :meth:`.delete`, the operations are diverted to the retry
+        :attr:`.buffer` while the :attr:`.breaker` is open. Returns a list of
+        errors for documents that could not be removed. These errors are also
+        logged.
+        """
+        doc_type = self._require_es_class(class_).__score_db__['type_name']
+        ids = list(ids)
+        errors = []
+        for i in range(0, len(ids), chunk_size):
+            errors += self._write_bulk([{
+                '_op_type': 'delete',
+                '_index': self.index,
+                '_type': doc_type,
+                '_id': id,
+            } for id in ids[i:i + chunk_size]], timeout)
+        return errors
+
+    def reindex(self, query, *, chunk_size=500, timeout=None):
+        """
+        Re-inserts all objects returned by given SQLAlchemy *query* into the
+        index. The objects are retrieved from the database and sent to
+        elasticsearch in batches of *chunk_size* objects. Objects without a
+        :term:`top-most es class` are skipped.
+
+        Just like :meth:`.insert`, the operations are diverted to the retry
+        :attr:`.buffer` while the :attr:`.breaker` is open. Returns a list of
+        errors for documents that could not be indexed. These errors are also
+        logged.
+        """
+        actions = []
+        errors = []
+        for obj in query.yield_per(chunk_size):
+            if self.get_es_class(obj) is None:
+                continue
+            action = self._object2json(obj)
+            action['_op_type'] = 'index'
+            action['_index'] = self.index
+            actions.append(action)
+            if len(actions) >= chunk_size:
+                errors += self._write_bulk(actions, timeout)
+                actions = []
+        if actions:
+            errors += self._write_bulk(actions, timeout)
+        return errors
 
     def destroy(self):
         """
@@ -398,6 +1134,8 @@ class CtxProxy:
 
     def __getattr__(self, attr):
         result = getattr(self._conf, attr)
-        if attr in ('query', 'refresh'):
+        if attr in ('query', 'search', 'refresh'):
             result = partial(result, self._ctx)
+            # __getattr__ is not consulted for attributes found in __dict__
+            setattr(self, attr, result)
         return result
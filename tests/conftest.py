@@ -0,0 +1,184 @@
+from threading import Lock
+import json
+import time
+
+from elasticsearch.exceptions import ConnectionError, NotFoundError
+from elasticsearch.serializer import JSONSerializer
+import pytest
+
+from score.es import ConfiguredEsModule, CircuitBreaker
+import score.es._breaker
+
+
+class FakeTransport:
+    serializer = JSONSerializer()
+
+
+class FakeEs:
+    """
+    Minimal stand-in for :class:`elasticsearch.Elasticsearch`, keeping the
+    indexed documents in memory. The :func:`elasticsearch.helpers.bulk` helper
+    works with this client, too. Setting :attr:`down` makes every request fail
+    with a :class:`ConnectionError`.
+    """
+
+    transport = FakeTransport()
+
+    def __init__(self):
+        self.down = False
+        self.delay = 0
+        self.docs = {}
+        self.log = []
+        self.search_result = {'hits': {'total': 0, 'hits': []}}
+        self.pending = 0
+        self.max_pending = 0
+        self._lock = Lock()
+
+    def _request(self):
+        if self.down:
+            raise ConnectionError('N/A', 'cluster down', None)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def index(self, *, index, doc_type, body, id, **kwargs):
+        self._request()
+        with self._lock:
+            self.docs[id] = body
+            self.log.append(('index', id, body))
+
+    def delete(self, *, index, doc_type, id, **kwargs):
+        self._request()
+        with self._lock:
+            self.log.append(('delete', id, None))
+            if self.docs.pop(id, None) is None:
+                raise NotFoundError(404, 'not found', {})
+
+    def bulk(self, body, index=None, **kwargs):
+        with self._lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        try:
+            self._request()
+            lines = iter(json.loads(line) for line in body.splitlines())
+            items = []
+            with self._lock:
+                for action in lines:
+                    op, meta = next(iter(action.items()))
+                    id = meta['_id']
+                    if op == 'delete':
+                        status = 200 if self.docs.pop(id, None) else 404
+                        self.log.append(('delete', id, None))
+                    else:
+                        self.docs[id] = next(lines)
+                        self.log.append((op, id, self.docs[id]))
+                        status = 201
+                    items.append({op: {'_id': id, 'status': status}})
+            return {'errors': False, 'items': items}
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def search(self, **kwargs):
+        self._request()
+        self.log.append(('search', None, kwargs))
+        return self.search_result
+
+    def delete_by_query(self, **kwargs):
+        self._request()
+        self.log.append(('delete_by_query', None, kwargs))
+
+
+class Session:
+    """
+    Stand-in for a :mod:`score.db` session, retrieving objects from a dict.
+    """
+
+    def __init__(self, objects=()):
+        self.objects = {(type(obj), obj.id): obj for obj in objects}
+        self.by_ids_calls = []
+
+    def query(self, class_):
+        return Query([obj for obj in self.objects.values()
+                      if isinstance(obj, class_)])
+
+    def by_ids(self, class_, ids):
+        self.by_ids_calls.append((class_, list(ids)))
+        # polymorphic, just like the real thing
+        objects = {obj.id: obj for obj in self.objects.values()
+                   if isinstance(obj, class_)}
+        return [objects.get(id) for id in ids]
+
+
+class Query:
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def yield_per(self, count):
+        return iter(self.objects)
+
+
+class Ctx:
+
+    def __init__(self, session):
+        self.db = session
+
+
+class Base:
+    __score_db__ = {'type_name': 'base', 'parent': None}
+
+
+class Text(Base):
+    __score_db__ = {'type_name': 'text', 'parent': Base}
+    __score_es__ = {'title': {'type': 'string'}}
+
+    def __init__(self, id, title=''):
+        self.id = id
+        self.title = title
+
+
+class SillyText(Text):
+    __score_db__ = {'type_name': 'silly_text', 'parent': Text}
+
+
+class User(Base):
+    __score_db__ = {'type_name': 'user', 'parent': Base}
+    __score_es__ = {'name': {'type': 'string'}}
+
+    def __init__(self, id, name=''):
+        self.id = id
+        self.name = name
+
+
+class Db:
+    Base = Base
+    ctx_member = 'db'
+
+
+@pytest.fixture
+def es():
+    return FakeEs()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replaces the clock of the circuit breaker. Advance it by assigning to
+    ``clock.now``.
+    """
+    class Clock:
+        now = 1000.0
+    clock = Clock()
+    monkeypatch.setattr(score.es._breaker, 'time', lambda: clock.now)
+    return clock
+
+
+@pytest.fixture
+def module(es):
+    return ConfiguredEsModule(Db, es, 'test')
+
+
+@pytest.fixture
+def breaker_module(es, clock):
+    breaker = CircuitBreaker(2, cooldown=30)
+    return ConfiguredEsModule(Db, es, 'test', breaker=breaker)
@@ -0,0 +1,165 @@
+from threading import Thread, Event
+import logging
+
+import pytest
+
+from score.es import ConfiguredEsModule, CircuitBreaker, CircuitOpenError
+
+from conftest import Ctx, Db, Session, Text
+
+
+def trip(module):
+    module.es.down = True
+    module.insert(Text(100, 'trip'))
+    module.insert(Text(101, 'trip'))
+    assert module.breaker.open
+
+
+def test_breaker_opens_after_failures(clock):
+    breaker = CircuitBreaker(2, cooldown=10)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.open
+    assert not breaker.allow()
+    clock.now += 9
+    assert not breaker.allow()
+
+
+def test_breaker_counts_slow_requests(clock):
+    breaker = CircuitBreaker(1, latency=0.5, cooldown=10)
+    breaker.success(0.1)
+    assert not breaker.open
+    breaker.success(1)
+    assert not breaker.allow()
+
+
+def test_breaker_lets_single_probe_pass(clock):
+    breaker = CircuitBreaker(1, cooldown=10)
+    breaker.failure()
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success(0)
+    assert not breaker.open
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_writes_are_buffered_in_order(breaker_module, clock):
+    module = breaker_module
+    trip(module)
+    module.insert(Text(1, 'v1'))
+    module.delete(Text(100))
+    assert len(module.buffer) == 4
+    module.es.down = False
+    module.insert(Text(1, 'v2'))
+    assert len(module.buffer) == 5
+    assert not module.es.log
+    clock.now += 30
+    module.insert(Text(2))
+    assert not module.buffer
+    assert [(op, id) for op, id, _ in module.es.log] == [
+        ('index', 100), ('index', 101), ('index', 1), ('delete', 100),
+        ('index', 1), ('index', 2)]
+    assert module.es.docs[1]['title'] == 'v2'
+    assert 100 not in module.es.docs
+
+
+def test_writes_wait_for_running_flush(breaker_module, clock):
+    module = breaker_module
+    trip(module)
+    module.insert(Text(1, 'v1'))
+    module.es.down = False
+    clock.now += 30
+    started, proceed = Event(), Event()
+    bulk = module.es.bulk
+
+    def slow_bulk(*args, **kwargs):
+        started.set()
+        proceed.wait(5)
+        return bulk(*args, **kwargs)
+    module.es.bulk = slow_bulk
+    flush = Thread(target=module.flush_buffer)
+    flush.start()
+    started.wait(5)
+    module.insert(Text(1, 'v2'))
+    proceed.set()
+    flush.join()
+    assert not module.buffer
+    assert module.es.docs[1]['title'] == 'v2'
+
+
+def test_concurrent_writes(breaker_module, clock):
+    module = breaker_module
+    trip(module)
+    module.es.down = False
+    module.es.delay = 0.001
+    clock.now += 30
+    errors = []
+
+    def write(id):
+        try:
+            module.insert(Text(id))
+        except Exception as e:
+            errors.append(e)
+    threads = [Thread(target=write, args=(id,)) for id in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    module.flush_buffer()
+    assert not errors
+    assert sorted(module.es.docs) == list(range(20)) + [100, 101]
+
+
+def test_buffer_overflow_is_logged(es, clock, caplog):
+    module = ConfiguredEsModule(Db, es, 'test', buffer_size=3,
+                                breaker=CircuitBreaker(2, cooldown=30))
+    trip(module)
+    with caplog.at_level(logging.WARNING):
+        for id in range(3):
+            module.insert(Text(id))
+    assert [a['_id'] for a in module.buffer] == [0, 1, 2]
+    assert 'discarding 1 operations' in caplog.text
+
+
+def test_unsendable_buffer_is_discarded(breaker_module, clock):
+    module = breaker_module
+    trip(module)
+    module.insert(Text(1, object()))
+    module.es.down = False
+    clock.now += 30
+    module.flush_buffer()
+    assert not module.buffer
+    module.insert(Text(2))
+    assert 2 in module.es.docs
+
+
+def test_query_raises_while_open(breaker_module, clock):
+    module = breaker_module
+    trip(module)
+    with pytest.raises(CircuitOpenError):
+        list(module.query(Ctx(Session()), Text, 'title:parrot'))
+
+
+def test_query_fallback(es, clock):
+    calls = []
+
+    def fallback(ctx, class_, query, **kwargs):
+        calls.append((ctx, class_, query, kwargs))
+        return [Text(7)]
+    module = ConfiguredEsModule(Db, es, 'test', fallback=fallback,
+                                breaker=CircuitBreaker(2, cooldown=30))
+    trip(module)
+    ctx = Ctx(Session())
+    result = list(module.query(ctx, Text, 'title:parrot', limit=5))
+    assert [obj.id for obj in result] == [7]
+    assert calls == [(ctx, Text, 'title:parrot', {
+        'analyze_wildcard': False, 'offset': 0, 'limit': 5})]
+    assert not [entry for entry in es.log if entry[0] == 'search']
@@ -0,0 +1,123 @@
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+import pytest
+
+from score.es import init
+
+from conftest import Base, Session, SillyText, Text, User as EsUser
+
+
+@pytest.fixture
+def setup(es):
+    SqlBase = declarative_base()
+    SqlBase.__score_db__ = {'type_name': 'base', 'parent': None}
+
+    class User(SqlBase):
+        __tablename__ = 'user'
+        __score_db__ = {'type_name': 'user', 'parent': None}
+        __score_es__ = {'status': {'type': 'string'}}
+        id = Column(Integer, primary_key=True)
+        status = Column(String)
+
+    class Db:
+        pass
+    db = Db()
+    db.Base = SqlBase
+    db.Session = sessionmaker(bind=create_engine('sqlite://'))
+    db.ctx_member = 'db'
+    SqlBase.metadata.create_all(db.Session.kw['bind'])
+    es_conf = init({'bulk_events': 'true'}, db)
+    es_conf._es = es
+    session = db.Session()
+    session.add_all([User(status='active') for _ in range(4)])
+    session.flush()
+    return es_conf, session, User
+
+
+@pytest.mark.parametrize('synchronize_session', ['fetch', 'evaluate'])
+def test_bulk_update(setup, synchronize_session):
+    es_conf, session, User = setup
+    session.query(User).filter(User.id > 2).filter(User.status == 'active').\
+        update({'status': 'archived'}, synchronize_session=synchronize_session)
+    statuses = {id: body['status'] for id, body in es_conf.es.docs.items()}
+    assert statuses == {1: 'active', 2: 'active', 3: 'archived', 4: 'archived'}
+
+
+def test_bulk_update_unsynchronized(setup, caplog):
+    es_conf, session, User = setup
+    session.query(User).update({'status': 'archived'},
+                               synchronize_session=False)
+    assert all(body['status'] == 'active'
+               for body in es_conf.es.docs.values())
+    assert 'synchronize_session="fetch"' in caplog.text
+
+
+@pytest.mark.parametrize('synchronize_session', ['fetch', 'evaluate'])
+def test_bulk_delete(setup, synchronize_session):
+    es_conf, session, User = setup
+    session.query(User).filter(User.id > 2).\
+        delete(synchronize_session=synchronize_session)
+    assert sorted(es_conf.es.docs) == [1, 2]
+
+
+def test_delete_by_query(module):
+    module.delete_by_query(Text)
+    module.delete_by_query(Text, 'title:parrot')
+    module.delete_by_query(SillyText, {'match': {'title': 'parrot'}})
+    requests = [(kwargs['doc_type'], kwargs['body'])
+                for op, _, kwargs in module.es.log]
+    assert requests == [
+        ('text', {'query': {'match_all': {}}}),
+        ('text', {'query': {'query_string': {'query': 'title:parrot'}}}),
+        ('text', {'query': {'bool': {'must': [
+            {'match': {'title': 'parrot'}},
+            {'term': {'class': 'silly_text'}},
+        ]}}}),
+    ]
+
+
+def test_bulk_apis_require_es_class(module):
+    with pytest.raises(ValueError):
+        module.delete_by_query(Base)
+    with pytest.raises(ValueError):
+        module.delete_ids(Base, [1])
+
+
+def test_delete_ids(module):
+    for id in range(5):
+        module.insert(Text(id))
+    assert module.delete_ids(SillyText, [1, 2, 3, 9], chunk_size=3) == []
+    assert sorted(module.es.docs) == [0, 4]
+
+
+def test_reindex(module):
+    session = Session([Text(1, 'parrot'), SillyText(2, 'ex-parrot'),
+                       EsUser(3)])
+    assert module.reindex(session.query(Text), chunk_size=1) == []
+    assert module.es.docs == {
+        1: {'title': 'parrot', 'class': ['text'], 'concrete_class': 'text'},
+        2: {'title': 'ex-parrot', 'class': ['silly_text', 'text'],
+            'concrete_class': 'silly_text'},
+    }
+
+
+def test_bulk_writes_keep_order_with_buffer(breaker_module, clock):
+    module = breaker_module
+    module.es.down = True
+    module.insert(Text(1, 'v1'))
+    module.insert(Text(2, 'v1'))
+    assert module.breaker.open
+    module.es.down = False
+    clock.now += 30
+    module.reindex(Session([Text(1, 'v2')]).query(Text))
+    module.insert(Text(3))
+    assert module.es.docs[1]['title'] == 'v2'
+    module.es.down = True
+    module.insert(Text(4))
+    module.insert(Text(5))
+    module.es.down = False
+    clock.now += 30
+    module.delete_ids(Text, [4])
+    module.flush_buffer()
+    assert sorted(module.es.docs) == [1, 2, 3, 5]
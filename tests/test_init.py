@@ -0,0 +1,71 @@
+from threading import Thread, Barrier
+import time
+
+import pytest
+
+from score.es import ConfiguredEsModule
+from score.es._init import CtxProxy
+
+from conftest import Base, Ctx, Db, FakeEs, Session, SillyText, Text, User
+
+
+def test_client_required():
+    with pytest.raises(ValueError):
+        ConfiguredEsModule(Db, None, 'test')
+
+
+def test_lazy_client():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        time.sleep(0.01)
+        return FakeEs()
+    module = ConfiguredEsModule(Db, None, 'test', es_factory=factory)
+    assert not calls
+    barrier = Barrier(8)
+    clients = []
+
+    def access():
+        barrier.wait()
+        clients.append(module.es)
+    threads = [Thread(target=access) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(client is clients[0] for client in clients)
+
+
+def test_precompute(module):
+    module._precompute()
+    assert set(module._converters) == {Text, SillyText, User}
+    assert module._es_classes[SillyText] is Text
+
+
+def test_classes_defined_later(module):
+    module._precompute()
+    assert module.classes() == [Text, User]
+
+    class Late(Base):
+        __score_db__ = {'type_name': 'late', 'parent': Base}
+        __score_es__ = {}
+
+        def __init__(self, id):
+            self.id = id
+    assert module.classes() == [Text, User, Late]
+    module.insert(Late(1))
+    assert module.es.docs[1]['concrete_class'] == 'late'
+
+
+def test_ctx_proxy(module):
+    ctx = Ctx(Session([Text(1)]))
+    module.es.search_result = {
+        'hits': {'total': 1, 'hits': [{'_type': 'text', '_id': '1'}]}}
+    proxy = CtxProxy(module, ctx)
+    assert proxy.query is proxy.query
+    assert proxy.search is proxy.search
+    assert [obj.id for obj in proxy.query(Text, 'parrot')] == [1]
+    assert proxy.index == 'test'
+    assert proxy.es is module.es
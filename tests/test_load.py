@@ -0,0 +1,53 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from score.es import ConfiguredEsModule
+
+from conftest import Ctx, Db, FakeEs, Session, SillyText, Text, User
+
+
+def mkfile(count, truncate=False):
+    lines = []
+    for id in range(count):
+        lines.append(json.dumps({'index': {'_type': 'text', '_id': id}}))
+        lines.append(json.dumps({'title': 'doc%d' % id}))
+    if truncate:
+        lines.pop()
+    return io.BytesIO(gzip.compress(('\n'.join(lines) + '\n').encode()))
+
+
+def test_load(module):
+    module.es.delay = 0.005
+    assert module.load(mkfile(95), thread_count=3, chunk_size=10) == 95
+    assert sorted(module.es.docs) == list(range(95))
+    assert module.es.max_pending <= 3
+
+
+def test_load_truncated(module):
+    with pytest.raises(ValueError):
+        module.load(mkfile(5, truncate=True), chunk_size=2)
+
+
+def test_refresh_to_file_and_load(module):
+    ctx = Ctx(Session([Text(1, 'parrot'), SillyText(2, 'ex-parrot'),
+                       User(3, 'graham')]))
+    file = io.BytesIO()
+    module.refresh(ctx, file=file)
+    assert not module.es.log
+    file.seek(0)
+    other = ConfiguredEsModule(Db, FakeEs(), 'other')
+    assert other.load(file) == 3
+    assert other.es.docs == {
+        1: {'title': 'parrot', 'class': ['text'], 'concrete_class': 'text'},
+        2: {'title': 'ex-parrot', 'class': ['silly_text', 'text'],
+            'concrete_class': 'silly_text'},
+        3: {'name': 'graham', 'class': ['user'], 'concrete_class': 'user'},
+    }
+
+
+def test_refresh_to_file_rejects_timeout(module):
+    with pytest.raises(ValueError):
+        module.refresh(Ctx(Session()), file=io.BytesIO(), timeout=5)
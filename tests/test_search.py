@@ -0,0 +1,45 @@
+from conftest import Ctx, Session, SillyText, Text, User
+
+
+def hits(*hits):
+    return [{'_type': type, '_id': str(id)} for type, id in hits]
+
+
+def test_query_hydrates_in_order(module):
+    session = Session([Text(1), SillyText(2), User(3), Text(5), User(6)])
+    module.es.search_result = {'hits': {'total': 6, 'hits': hits(
+        ('text', 1), ('user', 3), ('text', 2), ('text', 4), ('user', 6),
+        ('text', 5))}}
+    result = list(module.query(Ctx(session), [Text, User], 'parrot'))
+    assert [(type(obj), obj.id) for obj in result] == [
+        (Text, 1), (User, 3), (SillyText, 2), (User, 6), (Text, 5)]
+    assert session.by_ids_calls == [(Text, [1, 2, 4, 5]), (User, [3, 6])]
+
+
+def test_search(module):
+    session = Session([Text(1), Text(2)])
+    aggregations = {'concrete_class': {'buckets': [
+        {'key': 'text', 'doc_count': 2}]}}
+    module.es.search_result = {
+        'hits': {'total': 42, 'hits': hits(('text', 2), ('text', 3),
+                                           ('text', 1))},
+        'aggregations': aggregations,
+    }
+    result = module.search(Ctx(session), Text, 'parrot', limit=3)
+    assert [obj.id for obj in result.hits] == [2, 1]
+    assert result.total == 42
+    assert result.aggregations == aggregations
+    request = module.es.log[-1][2]
+    assert request['q'] == 'parrot'
+    assert request['body']['aggs'] == {
+        'class': {'terms': {'field': 'class', 'size': 2}},
+        'concrete_class': {'terms': {'field': 'concrete_class', 'size': 2}},
+    }
+
+
+def test_search_custom_aggregations(module):
+    aggregations = {'titles': {'terms': {'field': 'title'}}}
+    module.search(Ctx(Session()), Text, {'match_all': {}},
+                  aggregations=aggregations)
+    body = module.es.log[-1][2]['body']
+    assert body == {'query': {'match_all': {}}, 'aggs': aggregations}